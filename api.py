@@ -1,119 +1,208 @@
 '''API to Display Users, Images, and Discrepancies'''
 
+import itertools
+import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from flask import Flask, jsonify
+from flask.json.provider import JSONProvider
+from flask_caching import Cache
 from flask_restful import Api, Resource
-from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy import create_engine, event, select, MetaData
 from sqlalchemy.orm import sessionmaker
 
-from main import deconstruct_tags
+from context_manager import DB_PATH, get_dataset
+from main import deconstruct_tags, iter_png_files
 
 # pylint: disable = C0301
+
+
+class ORJSONProvider(JSONProvider):
+    """Serializes JSON responses with orjson instead of the stdlib json module"""
+
+    # Reflected column names are str subclasses, which orjson only accepts as keys with this flag
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        """Serialize obj to a JSON string."""
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        """Deserialize a JSON string or bytes."""
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """Build a JSON response from the encoded bytes, skipping the str round trip."""
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 api = Api(app)
 
+# Responses only change when rows or picture files change, so serve them from an in-process cache
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
+TABLE_CACHE_TIMEOUT = 10
+DIFFERENCES_CACHE_TIMEOUT = 60
+
 # Configure the SQLite database
-DATABASE_URL = 'sqlite:///databaseA10.db'
-db_connect = create_engine(DATABASE_URL)
+DATABASE_URL = f'sqlite:///{DB_PATH}'
+db_connect = create_engine(DATABASE_URL, pool_size=5, max_overflow=10)
 Session = sessionmaker(bind=db_connect)
 session = Session()
 
-# Reflect the database schema to access existing tables
-metadata = MetaData()
+# Threads used to scan user picture folders in Differences
+DISK_SCAN_WORKERS = 8
 
-# Define tables based on their names in the database, reflecting the schema
-users = Table('users', metadata, autoload_with=db_connect)
-pictures = Table('pictures', metadata, autoload_with=db_connect)
+
+@event.listens_for(db_connect, "connect")
+def _enable_foreign_keys(dbapi_connection, _connection_record):
+    """Turn on SQLite foreign key enforcement for every new pooled connection."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# Opening the dataset first adds the deleted_at columns to databases from before soft deletes
+get_dataset(DB_PATH)
+
+# Reflect the database schema to access existing tables, both tables in one pass
+metadata = MetaData()
+metadata.reflect(bind=db_connect, only=['users', 'pictures'])
+
+# Define tables based on their names in the database
+users = metadata.tables['users']
+pictures = metadata.tables['pictures']
+
+
+def live_users(query):
+    """Filter soft-deleted users out of a query."""
+    return query.where(users.c.deleted_at.is_(None))
+
+
+def _sorted_difference(left, right):
+    """
+    Walk two sorted lists together in one pass.
+    Returns the distinct items only found in left and those only found in right.
+    """
+    only_left, only_right = [], []
+    i = j = 0
+    while i < len(left) or j < len(right):
+        if j == len(right) or (i < len(left) and left[i] < right[j]):
+            item, target = left[i], only_left
+        elif i == len(left) or right[j] < left[i]:
+            item, target = right[j], only_right
+        else:
+            item, target = left[i], None  # In both lists
+        # Skip every copy of item on both sides
+        while i < len(left) and left[i] == item:
+            i += 1
+        while j < len(right) and right[j] == item:
+            j += 1
+        if target is not None:
+            target.append(item)
+    return only_left, only_right
 
 
 # API Resources
 class Users(Resource):
     """Displays all users in database"""
 
+    @cache.cached(timeout=TABLE_CACHE_TIMEOUT)
     def get(self):
         """Fetch all users from the database."""
-        conn = db_connect.connect()
-        query = users.select()
-        users_result = conn.execute(query).fetchall()
+        query = live_users(select(users.c.user_id, users.c.user_name, users.c.user_last_name, users.c.user_email))
+        with db_connect.connect() as conn:  # Returns the connection to the pool when done
+            users_result = conn.execution_options(yield_per=1000).execute(query).mappings()
+            users_list = [dict(row) for row in users_result]  # jsonify needs plain dicts
 
-        users_list = [row._asdict() for row in users_result]  # Convert each row to dict
-
-        if users_list:
-            return jsonify(users_list)  # Return as a JSON array
-        return jsonify([])
+        return jsonify(users_list)  # Return as a JSON array (empty if no users)
 
 
 class Images(Resource):
     """Displays all images in database"""
 
+    @cache.cached(timeout=TABLE_CACHE_TIMEOUT)
     def get(self):
         """Fetch all images from the database."""
-        conn = db_connect.connect()
-        query = pictures.select()
-        images_result = conn.execute(query).fetchall()
-
-        images_list = [row._asdict() for row in images_result]
+        query = select(pictures.c.picture_id, pictures.c.user_id, pictures.c.tags)
+        with db_connect.connect() as conn:
+            images_result = conn.execution_options(yield_per=1000).execute(query).mappings()
+            images_list = [dict(row) for row in images_result]
 
-        if images_list:
-            return jsonify(images_list)  # Return as a JSON array
-        return jsonify([])
+        return jsonify(images_list)  # Return as a JSON array (empty if no images)
 
 
 class Differences(Resource):
     """Displays all differences in database and disk"""
 
+    @cache.cached(timeout=DIFFERENCES_CACHE_TIMEOUT)
     def get(self):
         """Find discrepancies between image records and actual files on disk."""
-        conn = db_connect.connect()
-        users_list = self.get_users_list(conn)
+        query = live_users(select(users.c.user_id, pictures.c.picture_id, pictures.c.tags).select_from(
+            users.outerjoin(pictures, users.c.user_id == pictures.c.user_id)
+        )).order_by(users.c.user_id)
+
+        with db_connect.connect() as conn:
+            rows = conn.execution_options(stream_results=True).execute(query)
+            db_images = {
+                user_id: self.get_images_from_db(user_id, records)
+                for user_id, records in itertools.groupby(rows, key=lambda row: row.user_id)
+            }
+
+        # Users with neither picture rows nor a picture folder cannot have discrepancies
+        disk_users = self.get_users_on_disk()
+        user_ids = [user_id for user_id, images in db_images.items() if images or user_id in disk_users]
+
+        # Disk scans are independent and I/O bound, so run them concurrently
+        with ThreadPoolExecutor(max_workers=DISK_SCAN_WORKERS) as executor:
+            disk_images = dict(zip(user_ids, executor.map(
+                lambda user_id: self.get_images_from_disk(user_id) if user_id in disk_users else [],
+                user_ids
+            )))
 
         differences = []
-        for user in users_list:
-            user_id = user['user_id']  # Access user_id from the dictionary
-
-            db_images = self.get_images_from_db(conn, user_id)
-            disk_images = self.get_images_from_disk(user_id)
-
+        for user_id in user_ids:
             # Compare and find discrepancies
-            missing_in_db = set(disk_images) - set(db_images)
-            missing_on_disk = set(db_images) - set(disk_images)
+            missing_in_db, missing_on_disk = _sorted_difference(
+                sorted(disk_images[user_id]), sorted(db_images[user_id])
+            )
 
             if missing_in_db or missing_on_disk:
                 differences.append({
                     "user_id": user_id,
-                    "missing_in_db": list(missing_in_db),
-                    "missing_on_disk": list(missing_on_disk)
+                    "missing_in_db": missing_in_db,
+                    "missing_on_disk": missing_on_disk
                 })
 
         return jsonify(differences)
 
-    def get_users_list(self, conn):
-        """Fetch and return the list of users."""
-        users_query = users.select()
-        users_result = conn.execute(users_query).fetchall()
-        return [user._asdict() for user in users_result]
-
-    def get_images_from_db(self, conn, user_id):
-        """Fetch and return the list of image paths from the database."""
-        db_images = []
-        records_query = pictures.select().where(pictures.c.user_id == user_id)
-        records_result = conn.execute(records_query).fetchall()
-        records_list = [record._asdict() for record in records_result]
-
-        for record in records_list:
-            tags_path = pathlib.Path(user_id) / pathlib.Path(*deconstruct_tags(record['tags']))
-            full_image_path = tags_path.joinpath(f"{record['picture_id']}.png")
-            db_images.append(str(full_image_path))
-        return db_images
+    def get_images_from_db(self, user_id, records):
+        """Build the list of image paths from a user's joined picture rows."""
+        return [
+            os.sep.join((user_id, *deconstruct_tags(record.tags), f"{record.picture_id}.png"))
+            for record in records
+            if record.picture_id is not None  # Skip the outer join row of a user with no pictures
+        ]
+
+    def get_users_on_disk(self):
+        """Return the names of the user folders under pictures."""
+        try:
+            with os.scandir("pictures") as entries:
+                return {entry.name for entry in entries if entry.is_dir(follow_symlinks=False)}
+        except FileNotFoundError:
+            return set()
 
     def get_images_from_disk(self, user_id):
         """List image files on disk for a given user."""
-        disk_images = []
         folder_path = pathlib.Path("pictures") / user_id
-        if folder_path.exists():
-            for img_path in folder_path.rglob('*.png'):
-                disk_images.append(str(img_path.relative_to(folder_path.parent)))
-        return disk_images
+        base_len = len(str(folder_path.parent)) + 1  # Strip "pictures/" from each path
+        try:
+            return [img_path[base_len:] for img_path, _ in iter_png_files(folder_path)]
+        except FileNotFoundError:
+            return []  # User has no picture folder
 
 
 # Add resource routes to the API
@@ -2,9 +2,53 @@
 Connection to context_manager
 """
 
+import sqlite3
+from peewee import SqliteDatabase, __exception_wrapper__
 from playhouse.dataset import DataSet
 DB_PATH = 'databaseA10.db'
 
+# WAL + NORMAL sync: commits no longer wait on an fsync of the main database file.
+# Temp tables in memory and a 64 MB page cache (negative size is in KiB)
+# for the long-lived connection.
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'temp_store': 'memory',
+    'cache_size': -64000,
+}
+
+# Tables whose rows are soft-deleted by setting deleted_at instead of being removed
+SOFT_DELETE_TABLES = ('users', 'status')
+
+# One DataSet per database file, shared by every Connection
+_datasets = {}
+
+
+class PreparedConnection(sqlite3.Connection):  # pylint: disable=R0903
+    """
+    sqlite3 connection that keeps the cursors used by Connection.exec, keyed by SQL text,
+    so they are released together with the connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+def get_dataset(db_path=DB_PATH):
+    """
+    Returns the shared DataSet for db_path, opening it on first use
+    """
+    if db_path not in _datasets:
+        ds = DataSet(SqliteDatabase(db_path, pragmas=PRAGMAS, factory=PreparedConnection))
+        for table_name in SOFT_DELETE_TABLES:
+            if 'deleted_at' not in ds[table_name].columns:
+                ds.query(f'ALTER TABLE "{table_name}" ADD COLUMN "deleted_at" REAL')
+                ds.update_cache(table_name)
+        _datasets[db_path] = ds
+    return _datasets[db_path]
+
+
 class Connection:
     """
     Creates a SQLite connection as a context manager
@@ -14,7 +58,7 @@ class Connection:
         """
         Creates the database
         """
-        self.ds = DataSet(f'sqlite:///{db_path}')
+        self.ds = get_dataset(db_path)
         self.user_table = None
         self.status_table = None
         self.picture_table = None
@@ -23,14 +67,34 @@ class Connection:
         """
         Establishes initial connections
         """
+        self.ds.connect(reuse_if_open=True)
         self.user_table = self.ds['users']
         self.status_table = self.ds['status']
         self.picture_table = self.ds["pictures"]
 
         return self
 
+    @property
+    def prepared(self):
+        """
+        Cursors already used on this thread's SQLite connection, keyed by SQL text
+        """
+        return self.ds._database.connection().prepared  # pylint: disable=W0212
+
+    def exec(self, sql, params=()):
+        """
+        Runs raw SQL, reusing the cursor from the last time the same SQL ran on this
+        connection. The result must be read before the same SQL is run again.
+        Errors are raised as peewee exceptions, the same as ds.query().
+        """
+        prepared = self.prepared
+        cursor = prepared.get(sql)
+        if cursor is None:
+            cursor = prepared[sql] = self.ds._database.cursor()  # pylint: disable=W0212
+        with __exception_wrapper__:
+            return cursor.execute(sql, params)
+
     def __exit__(self, exc_type, exc_value, exc_traceback):
         """
-        Removes the connection to the database
+        Leaves the shared connection open so the next Connection can reuse it
         """
-        self.ds.close()
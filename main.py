@@ -2,11 +2,17 @@
 Main driver for a simple social network project using a functional approach
 """
 
+import collections
 import csv
+import functools
+import itertools
 import logging
-import pathlib
+import os
+import re
+import time
+import types
 from peewee import IntegrityError
-from context_manager import Connection
+from context_manager import Connection, DB_PATH, SOFT_DELETE_TABLES
 
 # pylint: disable = C0301, E1101, W0718, W0613, W1514, E1121
 
@@ -14,8 +20,28 @@ USER_TABLE = "UserModel"
 STATUS_TABLE = "StatusModel"
 PICTURE_TABLE = "PictureModel"
 
+# A hashtag: '#' at the start of a word, up to the next whitespace
+TAG_PATTERN = re.compile(r"(?<!\S)#(\S+)")
+
+# Rows per INSERT when bulk loading CSV files
+BATCH_SIZE = 500
+
+# Most recent lookups kept by cached_find
+QUERY_CACHE_SIZE = 256
+
+# (index name, table, column, unique, where clause)
+INDEXES = (
+    ("idx_pictures_user", "pictures", "user_id", False, ""),
+    ("idx_pictures_pid", "pictures", "picture_id", True, ""),
+    # Soft-deleted users keep their row until purged, so only live user_ids must be unique
+    ("idx_users_uid_live", "users", "user_id", True, " WHERE deleted_at IS NULL"),
+)
+
 logging.basicConfig(level=logging.INFO)
 
+# (db_path, table name, find_one, query) -> result, least recently used first
+_query_cache = collections.OrderedDict()
+
 # Configure logging
 logging.basicConfig(
     filename='A09_logger.txt',
@@ -27,7 +53,11 @@ logging.basicConfig(
 def log_decorator(func):
     '''log decorator that can be added to a function. Returns a function_logs.txt file'''
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        # Skip formatting the arguments and result when INFO is filtered out
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return func(*args, **kwargs)
         logging.info("Calling function %s with arguments %s %s", func.__name__, args, kwargs)
         result = func(*args, **kwargs)
         logging.info("Function %s returned %s", func.__name__, result)
@@ -44,11 +74,84 @@ def init_database(db_path):
         db.create_table('statuses', ['status_id', 'user_id', 'status_text'])
         db.create_table('pictures', ['picture_id', 'user_id', 'picture_path'])
 
+    create_indexes(db_path)
     print("Database initialized successfully.")
 
 
+def create_indexes(db_path):
+    """
+    Creates the lookup indexes used by the API and menu queries.
+    Tables whose indexed column does not exist yet (nothing inserted) are skipped.
+    """
+    with Connection(db_path) as db:
+        db.exec("DROP INDEX IF EXISTS idx_users_uid")  # Replaced by idx_users_uid_live
+        for index_name, table_name, column, unique, where in INDEXES:
+            if column in db.ds[table_name].columns:
+                try:
+                    db.exec(
+                        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name} ON {table_name}({column}){where}"
+                    )
+                except IntegrityError:
+                    print(f"Could not create {index_name}: {table_name}.{column} has duplicate values.")
+
+
+def cached_find(db, db_path, table_name, find_one=False, **query):
+    """
+    Runs a find/find_one on a table, answering repeated lookups from an LRU cache.
+    Anything that writes to the table must call invalidate_query_cache for it.
+    """
+    key = (db_path, table_name, find_one, tuple(sorted(query.items())))
+    if key in _query_cache:
+        _query_cache.move_to_end(key)
+        return _query_cache[key]
+
+    table = db.ds[table_name]
+    result = table.find_one(**query) if find_one else list(table.find(**query))
+    _query_cache[key] = result
+    if len(_query_cache) > QUERY_CACHE_SIZE:
+        _query_cache.popitem(last=False)
+    return result
+
+
+def invalidate_query_cache(*table_names):
+    """Drops cached lookups on the given tables after they were written to."""
+    for key in [key for key in _query_cache if key[1] in table_names]:
+        del _query_cache[key]
+
+
+def insert_in_batches(db, table, rows, label, batch_size=BATCH_SIZE):
+    """
+    Inserts rows into a dataset table in batches of batch_size, all inside one transaction.
+    A batch that raises an IntegrityError is retried row by row so only the bad rows are skipped.
+    """
+    rows = iter(rows)
+    with db.ds.transaction():
+        for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            if not set(batch[0]).issubset(table.columns):
+                # Table.insert adds missing columns to the table, insert_many does not
+                insert_rows_one_by_one(db, table, batch[:1], label)
+                batch = batch[1:]
+            if not batch:
+                continue
+            try:
+                with db.ds.transaction():  # Savepoint so a failed batch can be retried
+                    table.model_class.insert_many(batch).execute()
+            except IntegrityError:
+                insert_rows_one_by_one(db, table, batch, label)
+
+
+def insert_rows_one_by_one(db, table, rows, label):
+    """Inserts rows individually, reporting the ones that raise an IntegrityError."""
+    for row in rows:
+        try:
+            with db.ds.transaction():
+                table.insert(**row)
+        except IntegrityError:
+            print(f"Failed to add {label} due to IntegrityError: {row}")
+
+
 # Load databases
-def load_users(db_path, filename):
+def load_users(db_path, filename, batch_size=BATCH_SIZE):
     """
     Opens a CSV file with user data and adds it to the database using ContextManager.
     """
@@ -56,29 +159,29 @@ def load_users(db_path, filename):
         with open(filename, encoding="utf-8", newline="") as csvfile:
             reader = csv.DictReader(csvfile)
             with Connection(db_path) as db:
-                user_table = db.user_table
-                for row in reader:
+                users = (
+                    {
+                        "user_id": row["USER_ID"],
+                        "user_email": row["EMAIL"],
+                        "user_name": row["NAME"],
+                        "user_last_name": row["LASTNAME"],
+                    }
+                    for row in reader
                     if all(
-                            key in row and row[key]
-                            for key in ["USER_ID", "EMAIL", "NAME", "LASTNAME"]
-                    ):
-                        user_data = {
-                            "user_id": row["USER_ID"],
-                            "user_email": row["EMAIL"],
-                            "user_name": row["NAME"],
-                            "user_last_name": row["LASTNAME"],
-                        }
-                        try:
-                            user_table.insert(**user_data)
-                        except IntegrityError:
-                            print(f"Failed to add user due to IntegrityError: {user_data}")
+                        key in row and row[key]
+                        for key in ["USER_ID", "EMAIL", "NAME", "LASTNAME"]
+                    )
+                )
+                insert_in_batches(db, db.user_table, users, "user", batch_size)
+            invalidate_query_cache("users")
+            create_indexes(db_path)
             return True
     except (FileNotFoundError, KeyError) as e:
         print(f"An error occurred while loading users: {e}")
         return False
 
 
-def load_status_updates(db_path, filename):
+def load_status_updates(db_path, filename, batch_size=BATCH_SIZE):
     """
     Opens a CSV file with status update data and adds it to the database using ContextManager.
     """
@@ -86,21 +189,20 @@ def load_status_updates(db_path, filename):
         with open(filename, encoding="utf-8", newline="") as csvfile:
             reader = csv.DictReader(csvfile)
             with Connection(db_path) as db:
-                status_table = db.status_table
-                for row in reader:
+                statuses = (
+                    {
+                        "status_id": row["STATUS_ID"],
+                        "user_id": row["USER_ID"],
+                        "status_text": row["STATUS_TEXT"],
+                    }
+                    for row in reader
                     if all(
-                            key in row and row[key]
-                            for key in ["STATUS_ID", "USER_ID", "STATUS_TEXT"]
-                    ):
-                        status_data = {
-                            "status_id": row["STATUS_ID"],
-                            "user_id": row["USER_ID"],
-                            "status_text": row["STATUS_TEXT"],
-                        }
-                        try:
-                            status_table.insert(**status_data)
-                        except IntegrityError:
-                            print(f"Failed to add status due to IntegrityError: {status_data}")
+                        key in row and row[key]
+                        for key in ["STATUS_ID", "USER_ID", "STATUS_TEXT"]
+                    )
+                )
+                insert_in_batches(db, db.status_table, statuses, "status", batch_size)
+            invalidate_query_cache("status")
             return True
     except (FileNotFoundError, KeyError) as e:
         print(f"An error occurred while loading statuses: {e}")
@@ -124,6 +226,7 @@ def add_user(db_path, user_id, user_name, user_last_name, user_email):
         try:
             user_table.insert(user_id=user_id, user_name=user_name, user_last_name=user_last_name,
                               user_email=user_email)
+            invalidate_query_cache("users")
             print(f"User {user_id} added successfully.")
             return True
         except Exception as e:
@@ -144,15 +247,13 @@ def update_user(db_path, user_id, user_name=None, user_last_name=None, user_emai
             user_table = db.user_table
 
             # Check if the user exists
-            user_to_modify = user_table.find_one(user_id=user_id)
+            user_to_modify = user_table.find_one(user_id=user_id, deleted_at=None)
             if not user_to_modify:
                 print("User not found.")
                 return False
 
             # Prepare the update data
             updated_data = {}
-            if user_id:
-                updated_data["user_id"] = user_id
             if user_email:
                 updated_data['user_email'] = user_email
             if user_name:
@@ -164,12 +265,9 @@ def update_user(db_path, user_id, user_name=None, user_last_name=None, user_emai
                 print("No fields to update.")
                 return False
 
-            # first delete the old record and then insert the updated record.
-            with db.ds.transaction():
-                # First, remove the old record
-                user_table.delete(user_id=user_id)
-                # Insert the updated record
-                user_table.insert(**updated_data)
+            # Update the provided fields in place; blank fields keep their current value
+            user_table.update(columns=["user_id", "deleted_at"], user_id=user_id, deleted_at=None, **updated_data)
+            invalidate_query_cache("users")
 
             print(f"User {user_id} updated successfully.")
             return True
@@ -178,40 +276,32 @@ def update_user(db_path, user_id, user_name=None, user_last_name=None, user_emai
         return False
 
 
-def delete_user(user_id):
-    """Delete a user and associated statuses and pictures from the database."""
-    with Connection() as db:
+def delete_user(user_id, db_path=DB_PATH):
+    """
+    Soft-deletes a user and their statuses, and deletes their pictures from the database.
+    Soft-deleted rows are removed for good by purge_deleted.
+    """
+    with Connection(db_path) as db:
         try:
-            # Flag to track if all deletions are successful
-            all_statuses_deleted = True
-            user_deleted = False
-
-            # Retrieve and delete all statuses associated with the user
-            statuses = db.status_table.find(user_id=user_id)
-            for status in statuses:
-                status_id = status["status_id"]
-                try:
-                    status_to_delete = db.status_table.find_one(status_id=status_id)
-                    if status_to_delete:
-                        db.status_table.delete(id=status_to_delete["id"])
-                    else:
-                        print(f"Status record not found for status_id: {status_id}")
-                        all_statuses_deleted = False
-                except Exception as e:
-                    print(f"Failed to delete status with status_id: {status_id}. Error: {e}")
-                    all_statuses_deleted = False
-
-            # Delete the user
-            user_to_delete = db.user_table.find_one(user_id=user_id)
-            if user_to_delete:
-                db.user_table.delete(id=user_to_delete["id"])
-                user_deleted = True
-            else:
+            user = db.user_table.model_class
+            status = db.status_table.model_class
+            deleted_at = time.time()
+            with db.ds.transaction():
+                if "user_id" in db.status_table.columns:  # Column only exists once a row was inserted
+                    status.update(deleted_at=deleted_at).where(
+                        (status.user_id == user_id) & status.deleted_at.is_null()
+                    ).execute()
+                if "user_id" in db.picture_table.columns:
+                    db.picture_table.delete(user_id=user_id)
+                user_deleted = user.update(deleted_at=deleted_at).where(
+                    (user.user_id == user_id) & user.deleted_at.is_null()
+                ).execute()
+            invalidate_query_cache("users", "status", "pictures")
+
+            if not user_deleted:
                 print(f"User record not found for user_id: {user_id}")
-                user_deleted = False
-
-            # Return True only if both statuses and user were successfully deleted
-            return all_statuses_deleted and user_deleted
+                return False
+            return True
 
         except Exception as e:
             print(f"An error occurred while deleting user: {e}")
@@ -226,7 +316,7 @@ def search_user(db_path):
     def search(user_id):
         with Connection(db_path) as db:
             try:
-                user = db.user_table.find_one(user_id=user_id)
+                user = cached_find(db, db_path, "users", find_one=True, user_id=user_id, deleted_at=None)
                 if user is None:
                     print(f"User with user_id {user_id} not found.")
                     return None
@@ -237,6 +327,17 @@ def search_user(db_path):
 
     return search
 
+def bind_user_operations(db_path):
+    """
+    Returns search_user, update_user and delete_user with db_path already filled in.
+    """
+    return types.SimpleNamespace(
+        search_user=search_user(db_path),
+        update_user=functools.partial(update_user, db_path),
+        delete_user=functools.partial(delete_user, db_path=db_path),
+    )
+
+
 # Status-related functions
 
 def add_status(db_path, status_id, user_id, status_text):
@@ -246,8 +347,9 @@ def add_status(db_path, status_id, user_id, status_text):
             user_table = db.user_table
             status_table = db.status_table
             # Ensure the user exists before adding status
-            if user_table.find_one(user_id=user_id):
+            if user_table.find_one(user_id=user_id, deleted_at=None):
                 status_table.insert(user_id=user_id, status_id=status_id, status_text=status_text)
+                invalidate_query_cache("status")
                 print(f"Status {status_id} added successfully.")
             else:
                 print(f"User {user_id} does not exist.")
@@ -262,7 +364,7 @@ def update_status(db_path, status_id, user_id=None, status_text=None):
             status_table = db.status_table
 
             # Check if the status exists
-            status_to_modify = status_table.find_one(status_id=status_id)
+            status_to_modify = status_table.find_one(status_id=status_id, deleted_at=None)
             if not status_to_modify:
                 print(f"Status record not found for status_id: {status_id}")
                 return False
@@ -284,33 +386,49 @@ def update_status(db_path, status_id, user_id=None, status_text=None):
                 print("No fields to update.")
                 return False
 
-            # Delete the old record first, then add the updated record
-            with db.ds.transaction():
-                status_table.delete(status_id=status_id)
-                status_table.insert(**updated_data)
-                print(f"Status {status_id} updated successfully.")
-                return True
+            # Update the record in place
+            status_table.update(columns=["status_id", "deleted_at"], deleted_at=None, **updated_data)
+            invalidate_query_cache("status")
+            print(f"Status {status_id} updated successfully.")
+            return True
     except Exception as e:
         print(f"Error updating status: {status_id}. Exception message: {e}")
         return False
 
 
 def delete_status(status_id):
-    """Delete a status update from the database."""
+    """Soft-delete a status update; purge_deleted removes it for good."""
     with Connection() as db:
-        statuses = db.status_table.find(status_id=status_id)
-        for status in statuses:
-            status_id = status["status_id"]
-            try:
-                status_to_delete = db.status_table.find_one(status_id=status_id)
-                if status_to_delete:
-                    db.status_table.delete(id=status_to_delete["id"])
-                    return True
-                print(f"Status record not found for status_id: {status_id}")
-                return False
-            except Exception as e:
-                print(f"Error deleting status: {e}")
-                return False
+        try:
+            status = db.status_table.model_class
+            status_deleted = status.update(deleted_at=time.time()).where(
+                (status.status_id == status_id) & status.deleted_at.is_null()
+            ).execute()
+            invalidate_query_cache("status")
+            if status_deleted:
+                return True
+            print(f"Status record not found for status_id: {status_id}")
+            return False
+        except Exception as e:
+            print(f"Error deleting status: {e}")
+            return False
+
+
+def purge_deleted(db_path):
+    """
+    Permanently removes soft-deleted users and statuses, then compacts the database file.
+    Returns the number of rows removed.
+    """
+    with Connection(db_path) as db:
+        with db.ds.transaction():
+            removed = sum(
+                db.exec(f'DELETE FROM "{table_name}" WHERE deleted_at IS NOT NULL').rowcount
+                for table_name in SOFT_DELETE_TABLES
+            )
+        db.exec("VACUUM")  # Cannot run inside a transaction
+    invalidate_query_cache(*SOFT_DELETE_TABLES)
+    print(f"Purged {removed} deleted records.")
+    return removed
 
 
 def search_status(db_path, status_id):
@@ -320,7 +438,7 @@ def search_status(db_path, status_id):
     with Connection(db_path) as db:
         try:
             # Correctly query the status table
-            status = db.status_table.find_one(status_id=status_id)
+            status = cached_find(db, db_path, "status", find_one=True, status_id=status_id, deleted_at=None)
             if status is None:
                 print(f"Status with status_id {status_id} not found.")
                 return None
@@ -330,13 +448,12 @@ def search_status(db_path, status_id):
             return None
 
 
+@functools.lru_cache(maxsize=8192)
 def deconstruct_tags(tags):
     '''
-    Deconstructs a string of tags into a list of tags
+    Deconstructs a string of tags into a sorted tuple of tags (cached, so the result is immutable)
     '''
-    tags = " " + tags  # Add extra space at the start so split works
-    tags_list = tags.split(" #")
-    return sorted(tags_list[1:])  # Skip the first empty slot and return a sorted list
+    return tuple(sorted(TAG_PATTERN.findall(tags)))
 
 
 def save_picture_to_disk(user_id, picture_id, tags):
@@ -347,11 +464,11 @@ def save_picture_to_disk(user_id, picture_id, tags):
     tag_list = deconstruct_tags(tags)
 
     # Create the folder path and make the directories
-    folder_path = pathlib.Path("pictures") / user_id / pathlib.Path(*tag_list)
-    folder_path.mkdir(parents=True, exist_ok=True)  # Create directories if they don't exist
+    folder_path = os.path.join("pictures", user_id, *tag_list)
+    os.makedirs(folder_path, exist_ok=True)  # Create directories if they don't exist
 
     # Create the file path and create an empty file
-    file_path = folder_path / f"{picture_id}.png"
+    file_path = os.path.join(folder_path, f"{picture_id}.png")
     with open(file_path, "w"):
         pass  # Creating an empty file (replace with actual file saving logic)
 
@@ -363,37 +480,24 @@ def add_picture(user_id, tags):
     Adds a picture to the database for a specific user and saves it to disk.
     """
     with Connection() as db:
-        picture = db.picture_table.model_class
         user = db.user_table.model_class
 
         # Check if the user ID exists in the USER_TABLE
-        user_exists = user.select().where(user.user_id == user_id).exists()
+        user_exists = user.select().where((user.user_id == user_id) & user.deleted_at.is_null()).exists()
 
         if not user_exists:
             print(f"User with ID {user_id} does not exist. Cannot add picture.")
             return False
 
-        # Find the last picture entry in the PICTURE_TABLE by ordering by ID descending
-        last_picture = picture.select().order_by(picture.id.desc()).limit(1).first()
-
-        # Generate a new picture_id
-        if last_picture:
-            last_id = int(last_picture.id)
-        else:
-            last_id = 0
-
-        new_picture_id = str(last_id + 1).zfill(10)  # Increment the last picture ID
-
-        # Insert the new picture into the database
         picture_data = {
-            'picture_id': new_picture_id,
             'user_id': user_id,
             'tags': tags
         }
 
         try:
-            # Insert the new picture into the database
-            db.picture_table.insert(**picture_data)
+            with db.ds.transaction():
+                new_picture_id = insert_picture(db, user_id, tags)
+            invalidate_query_cache("pictures")
             print(f"Picture {new_picture_id} added successfully for user {user_id}.")
 
             # Save the picture to disk after successfully adding it to the database
@@ -405,35 +509,79 @@ def add_picture(user_id, tags):
             return False
 
 
-def list_user_images(db_path, user_id):
-    """Recursively lists all image paths for a given user."""
+def insert_picture(db, user_id, tags):
+    """
+    Inserts a picture row and returns its new picture_id.
+    SQLite assigns the row id and the picture_id is derived from it.
+    """
+    new_id = db.picture_table.insert(user_id=user_id, tags=tags)
+    new_picture_id = str(new_id).zfill(10)
+    db.picture_table.update(columns=['id'], id=new_id, picture_id=new_picture_id)
+    return new_picture_id
 
-    def find_images(directory):
-        """Helper function to recursively find images in the given directory."""
-        images = []
-        for item in directory.iterdir():
-            if item.is_dir():
-                images.extend(find_images(item))
-            elif item.is_file() and item.suffix == ".png":
-                file_name = item.name
-                relative_path = item.relative_to(folder_path)
-                images.append((user_id, str(relative_path), file_name))
-        return images
 
-    folder_path = pathlib.Path("pictures") / user_id
+def add_pictures(pictures):
+    """
+    Adds several (user_id, tags) pictures in a single transaction and saves them to disk.
+    Pictures for unknown users are skipped. Returns the number of pictures added.
+    """
+    with Connection() as db:
+        user = db.user_table.model_class
+        user_ids = {user_id for user_id, _ in pictures}
+        known_users = {
+            row.user_id for row in user.select(user.user_id).where(user.user_id.in_(user_ids) & user.deleted_at.is_null())
+        }
 
-    try:
-        if not folder_path.exists():
-            print(f"No images found for user {user_id}.")
-            return []
+        added = []
+        try:
+            with db.ds.transaction():
+                for user_id, tags in pictures:
+                    if user_id not in known_users:
+                        print(f"User with ID {user_id} does not exist. Cannot add picture.")
+                        continue
+                    added.append((user_id, insert_picture(db, user_id, tags), tags))
+        except IntegrityError:
+            print(f"Failed to add pictures due to IntegrityError: {pictures}")
+            return 0
+
+        invalidate_query_cache("pictures")
+        for user_id, picture_id, tags in added:
+            save_picture_to_disk(user_id, picture_id, tags)
 
-        images = find_images(folder_path)
+        print(f"{len(added)} of {len(pictures)} pictures added.")
+        return len(added)
 
+
+def iter_png_files(root):
+    """
+    Yields (path, file name) for every .png file below root.
+    os.scandir entries carry the file type, so no extra stat() is needed per entry.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and entry.name.endswith(".png"):
+                    yield entry.path, entry.name
+
+
+def list_user_images(db_path, user_id):
+    """Recursively lists all image paths for a given user."""
+    folder_path = os.path.join("pictures", user_id)
+    base_len = len(os.path.join(folder_path, ""))  # Folder path with exactly one trailing separator
+
+    try:
+        images = [(user_id, path[base_len:], file_name) for path, file_name in iter_png_files(folder_path)]
         if images:
             return images
         print(f"No images found for user {user_id}.")
         return []
 
+    except FileNotFoundError:
+        print(f"No images found for user {user_id}.")
+        return []
     except Exception as e:
         print(f"Error retrieving pictures: {e}")
         return []
@@ -449,12 +597,12 @@ def reconcile_images(db_path, user_id):
     images_in_db = []
 
     with Connection(db_path) as conn:
-        records = conn.picture_table.find(user_id=user_id)
+        records = cached_find(conn, db_path, "pictures", user_id=user_id)
         for record in records:
-            tags_path = pathlib.Path(*deconstruct_tags(record["tags"]))
+            file_name = f"{record['picture_id']}.png"
             # Construct the full path with the image file name and extension
-            full_image_path = tags_path.joinpath(f"{record['picture_id']}.png")
-            images_in_db.append((user_id, str(full_image_path), f"{record['picture_id']}.png"))
+            full_image_path = os.sep.join((*deconstruct_tags(record["tags"]), file_name))
+            images_in_db.append((user_id, full_image_path, file_name))
 
     # Print out the lists for debugging
     print("Images on Disk:", images_on_disk)
@@ -2,54 +2,161 @@
 Provides a basic frontend for the social network project
 """
 
+import atexit
+import collections
+import functools
+import os
+import shlex
 import sys
+import types
 import main
 from context_manager import Connection, DB_PATH
 
 
 # pylint: disable = C0301, W0718
 
+_MENU_PROMPT = """
+                            A: Load user database
+                            B: Load status database
+                            C: Add user
+                            D: Update user
+                            E: Search user
+                            F: Delete user
+                            G: Add status
+                            H: Update status
+                            I: Search status
+                            J: Delete status
+                            K: Add picture
+                            L: List user images
+                            M: Reconcile images
+                            N: Toggle picture batch mode
+                            P: Purge deleted users and statuses
+                            X: Clear caches
+                            Q: Quit
+
+                            Please enter your choice: """
+
+HISTORY_FILE = os.path.expanduser("~/.menu_history")
+
+# Maximum lengths of the fields entered in add_user (no limit for email)
+USER_FIELD_MAX_LENGTHS = {"user_id": 30, "user_name": 30, "user_last_name": 100}
+
+# Set MENU_CACHE_STATS=1 to print lookup cache hits/misses after each search
+SHOW_CACHE_STATS = bool(os.environ.get("MENU_CACHE_STATS"))
+
+
+# User operations bound to the database once and reused by every handler
+_user_ops = main.bind_user_operations(DB_PATH)
+
+
+@functools.lru_cache(maxsize=1024)
+def _search_user_cached(user_id):
+    """
+    Looks up a user, remembering the result until users change
+    """
+    return _user_ops.search_user(user_id)
+
+
+@functools.lru_cache(maxsize=1024)
+def _search_status_cached(status_id):
+    """
+    Looks up a status, remembering the result until statuses change
+    """
+    return main.search_status(DB_PATH, status_id)
+
+
+# Arguments of the script line being run; None when running interactively
+_script = types.SimpleNamespace(answers=None)
+
+# Pictures queued by add_picture while batch mode is on, as (user_id, tags)
+_picture_batch = types.SimpleNamespace(active=False, pictures=[])
+
+
+def _user_data_changed():
+    """
+    Drops cached lookups after users (and their statuses) were modified
+    """
+    _search_user_cached.cache_clear()
+    _search_status_cached.cache_clear()
+
+
+class _MissingAnswer(Exception):
+    """
+    Raised when a script line has fewer answers than its command asks for
+    """
+
+
+def _ask(prompt, default=None):
+    """
+    Gets the answer to a prompt: from the current script line's arguments when
+    running scripted, otherwise from input(). A script line that has run out of
+    arguments answers optional prompts (those with a default) with the default.
+    """
+    if _script.answers is None:
+        return input(prompt)
+    if _script.answers:
+        return _script.answers.popleft()
+    if default is None:
+        raise _MissingAnswer(prompt.strip())
+    return default
+
+
+def _read_fields(labels):
+    """
+    Reads one value per label
+    """
+    return [_ask(label) for label in labels]
+
+
+def read_batch_size():
+    """
+    Asks how many rows to insert per batch when loading a file
+    """
+    batch_size = _ask(f"Rows per insert batch (leave blank/press enter for {main.BATCH_SIZE}): ", default="")
+    if batch_size.isdigit() and int(batch_size) > 0:
+        return int(batch_size)
+    return main.BATCH_SIZE
+
 
 def load_users():
     """
     Loads user accounts from a file
     """
-    filename = input("Enter filename of user file: ")
-    if not main.load_users(DB_PATH,filename):
+    filename = _ask("Enter filename of user file: ")
+    batch_size = read_batch_size()
+    if not main.load_users(DB_PATH, filename, batch_size):
         print("An error occurred while loading users.")
     else:
         print("Accounts loaded successfully.")
+    _search_user_cached.cache_clear()
 
 
 def load_status_updates():
     """
     Loads status updates from a file
     """
-    filename = input("Enter filename for status file: ")
-    if not main.load_status_updates(DB_PATH, filename):
+    filename = _ask("Enter filename for status file: ")
+    batch_size = read_batch_size()
+    if not main.load_status_updates(DB_PATH, filename, batch_size):
         print("An error occurred while loading status updates.")
     else:
         print("Status updates loaded successfully.")
+    _search_status_cached.cache_clear()
 
 
 def add_user():
     '''
     Adds a new user
     '''
-    user_id = input("User ID: ")
-    if not main.validate_length(user_id, 30):
-        return  # Exit the function if validation fails
-
-    user_name = input("User name: ")
-    if not main.validate_length(user_name, 30):
+    user_id, user_name, user_last_name, email = _read_fields(
+        ["User ID: ", "User name: ", "User last name: ", "User email: "]  # No length limit specified for email
+    )
+    fields = {"user_id": user_id, "user_name": user_name, "user_last_name": user_last_name}
+    too_long = next((key for key, value in fields.items() if len(value) > USER_FIELD_MAX_LENGTHS[key]), None)
+    if too_long:
+        print(f"Value '{fields[too_long]}' exceeds maximum length of {USER_FIELD_MAX_LENGTHS[too_long]} characters.")
         return  # Exit the function if validation fails
 
-    user_last_name = input("User last name: ")
-    if not main.validate_length(user_last_name, 100):
-        return  # Exit the function if validation fails
-
-    email = input("User email: ")  # No length limit specified for email
-
     user_data = {
         "user_id": user_id,
         "user_email": email,
@@ -57,6 +164,7 @@ def add_user():
         "user_last_name": user_last_name
     }
 
+    _search_user_cached.cache_clear()
     if not main.add_user(DB_PATH, user_id, user_name, user_last_name, email):
         print(f"Failed to add user: {user_data}")
     else:
@@ -67,13 +175,21 @@ def update_user():
     """
     Updates information for an existing user.
     """
-    user_id = input('User ID: ')
-    user_name = input('User name: ')
-    user_last_name = input('User last name: ')
-    user_email = input('User email: ')
+    if _script.answers is not None or (sys.stdin.isatty() and not os.environ.get("MENU_FAST_INPUT")):
+        user_id, user_name, user_last_name, user_email = _read_fields(
+            ['User ID: ', 'User name: ', 'User last name: ', 'User email: ']
+        )
+    else:
+        # Fast input: the whole record on one comma-separated line
+        fields = _ask('user_id,user_name,user_last_name,user_email: ').split(",", 3)
+        if len(fields) != 4:
+            print("Expected four comma-separated values: user_id,user_name,user_last_name,user_email")
+            return
+        user_id, user_name, user_last_name, user_email = fields
 
     # Call the function with correct argument order
-    if main.update_user(DB_PATH, user_id, user_name, user_last_name, user_email):
+    _search_user_cached.cache_clear()
+    if _user_ops.update_user(user_id, user_name, user_last_name, user_email):
         print("User was successfully updated")
     else:
         print("An error occurred while trying to update user; check user ID")
@@ -82,14 +198,17 @@ def search_user():
     """
     Searches for a user in the database.
     """
-    user_id = input('Enter user ID to search: ')
-    search_function = main.search_user(DB_PATH)
-    result = search_function(user_id)
+    user_id = _ask('Enter user ID to search: ')
+    result = _search_user_cached(user_id)
+    if SHOW_CACHE_STATS:
+        print(_search_user_cached.cache_info())
     if result:
-        print(f"User ID: {result['user_id']}")
-        print(f"Email: {result['user_email']}")
-        print(f"Name: {result['user_name']}")
-        print(f"Last name: {result['user_last_name']}")
+        print(
+            f"User ID: {result['user_id']}\n"
+            f"Email: {result['user_email']}\n"
+            f"Name: {result['user_name']}\n"
+            f"Last name: {result['user_last_name']}"
+        )
     else:
         print("User not found")
 
@@ -98,8 +217,9 @@ def delete_user():
     """
     Deletes a user from the database.
     """
-    user_id = input("Enter user ID to delete: ")
-    if main.delete_user(user_id):
+    user_id = _ask("Enter user ID to delete: ")
+    _user_data_changed()
+    if _user_ops.delete_user(user_id):
         print("User was successfully deleted.")
     else:
         print("An error occurred while trying to delete user; check user ID")
@@ -109,10 +229,11 @@ def add_status():
     """
     Adds a new status to the database.
     """
-    status_id = input("Status ID: ")
-    user_id = input("User ID: ")
-    status_text = input("Status text: ")
+    status_id = _ask("Status ID: ")
+    user_id = _ask("User ID: ")
+    status_text = _ask("Status text: ")
 
+    _search_status_cached.cache_clear()
     if main.add_status(DB_PATH, status_id, user_id, status_text) is None:
         print("New status was successfully added.")
     else:
@@ -123,15 +244,16 @@ def update_status():
     '''
     Updates information for an existing status.
     '''
-    status_id = input("Enter status ID to update: ")
+    status_id = _ask("Enter status ID to update: ")
 
     # Prompt for user_id but allow blank input (to keep the old user_id)
-    user_id = input("User ID (leave blank/press enter to keep the current user_id): ")
+    user_id = _ask("User ID (leave blank/press enter to keep the current user_id): ", default="")
 
     # Prompt for status text but allow blank input (to keep the old status_text)
-    status_text = input("Enter new status text (leave blank/press enter to keep the current status text): ")
+    status_text = _ask("Enter new status text (leave blank/press enter to keep the current status text): ", default="")
 
     # Pass user_id and status_text to main.update_status, but leave them as None if blank
+    _search_status_cached.cache_clear()
     if main.update_status(DB_PATH, status_id, user_id if user_id else None, status_text if status_text else None):
         print("Status was successfully updated.")
     else:
@@ -142,8 +264,10 @@ def search_status():
     """
     Searches for a status in the database.
     """
-    status_id = input('Enter status ID to search: ')
-    result = main.search_status(DB_PATH, status_id)  # Call search_status correctly
+    status_id = _ask('Enter status ID to search: ')
+    result = _search_status_cached(status_id)
+    if SHOW_CACHE_STATS:
+        print(_search_status_cached.cache_info())
 
     if result:
         print(f"Status ID: {result['status_id']}")
@@ -156,7 +280,8 @@ def delete_status():
     """
     Deletes a status from the database.
     """
-    status_id = input("Enter status ID to delete: ")
+    status_id = _ask("Enter status ID to delete: ")
+    _search_status_cached.cache_clear()
     if main.delete_status(status_id):
         print("Status was successfully deleted.")
     else:
@@ -167,30 +292,56 @@ def add_picture():
     """
     Adds a picture for a user.
     """
-    user_id = input("User ID: ")
-    tags = input("Enter hashtags (space-separated): ")
+    user_id = _ask("User ID: ")
+    tags = _ask("Enter hashtags (space-separated): ")
     if not main.validate_length(tags, 100):
         return  # Exit the function if validation fails
 
+    if _picture_batch.active:
+        _picture_batch.pictures.append((user_id, tags))
+        print(f"Picture queued ({len(_picture_batch.pictures)} waiting); toggle batch mode off to save them.")
+        return
+
     if main.add_picture(user_id, tags):
         print("Picture added successfully.")
     else:
         print("An error occurred while adding the picture.")
 
 
+def toggle_batch_mode():
+    """
+    Turns picture batch mode on, or off again, saving the queued pictures in one transaction.
+    """
+    if not _picture_batch.active:
+        _picture_batch.active = True
+        print("Batch mode on: pictures are queued until batch mode is turned off.")
+        return
+    _picture_batch.active = False
+    flush_picture_batch()
+    print("Batch mode off.")
+
+
+def flush_picture_batch():
+    """
+    Saves all queued pictures.
+    """
+    if _picture_batch.pictures:
+        main.add_pictures(_picture_batch.pictures)
+        _picture_batch.pictures.clear()
+
+
 def list_user_images():
     """
     Lists all images for a user.
     """
-    user_id = input("User ID: ")
+    user_id = _ask("User ID: ")
 
     try:
         images = main.list_user_images(DB_PATH, user_id)
 
         if images:
-            print(f"Images for user {user_id}:")
-            for img in images:
-                print(f"Path: {img}")
+            # One write for the whole listing instead of a print per image
+            sys.stdout.write(f"Images for user {user_id}:\n" + "".join(f"Path: {img}\n" for img in images))
         else:
             print("No images found.")
 
@@ -201,7 +352,7 @@ def reconcile_images():
     """
     Reconciles images stored in the database with those on disk.
     """
-    user_id = input("User ID: ")
+    user_id = _ask("User ID: ")
     not_in_db, not_on_disk = main.reconcile_images(DB_PATH, user_id)
 
     if not_in_db or not_on_disk:
@@ -210,6 +361,73 @@ def reconcile_images():
     else:
         print("No discrepancies found.")
 
+
+def purge_deleted():
+    """
+    Permanently removes deleted users and statuses and compacts the database.
+    """
+    main.purge_deleted(DB_PATH)
+
+
+def clear_caches():
+    """
+    Clears every lookup cache, reporting how well they were used.
+    """
+    for name, cache in (("User search", _search_user_cached), ("Status search", _search_status_cached)):
+        info = cache.cache_info()
+        print(f"{name} cache hits: {info.hits}/{info.hits + info.misses}")
+        cache.cache_clear()
+    main.invalidate_query_cache("users", "status", "pictures")
+    print("Caches cleared.")
+
+
+def invalid_option():
+    '''
+    Reports a menu choice that does not exist.
+    '''
+    print("Invalid option")
+
+
+def _enable_history():
+    """
+    Gives input() line editing and a history that persists between sessions.
+    """
+    try:
+        import readline  # pylint: disable = C0415  # Not available on every platform
+    except ImportError:
+        return
+    try:
+        readline.read_history_file(HISTORY_FILE)
+    except OSError:
+        pass  # No history yet
+    atexit.register(readline.write_history_file, HISTORY_FILE)
+
+
+def run_scripted(lines, options):
+    """
+    Runs menu commands non-interactively, one "<choice> <answers...>" per line, e.g.
+    C jdoe John Doe jdoe@example.com
+    Answers are shell-quoted, so use "" for a blank answer and quotes around
+    answers containing spaces, such as hashtags: K jdoe "#cat #dog"
+    Trailing optional answers may be left out; a line missing a required answer is skipped.
+    """
+    for line in lines:
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print(f"Could not parse line {line!r}: {e}")
+            continue
+        if not words:
+            continue  # Blank line
+        choice, *answers = words
+        _script.answers = collections.deque(answers)
+        try:
+            options.get(choice.upper(), invalid_option)()
+        except _MissingAnswer as e:
+            print(f"Skipped line {line.strip()!r}: no answer for {e}")
+    flush_picture_batch()
+
+
 def quit_program():
     '''
     Quits the program.
@@ -218,11 +436,13 @@ def quit_program():
 
 
 if __name__ == "__main__":
+    main.create_indexes(DB_PATH)
+    atexit.register(flush_picture_batch)  # Also on Q, EOF or Ctrl-C, so queued pictures are not lost
     with Connection(DB_PATH) as connection:
         user_table = connection.user_table
         status_table = connection.status_table
         picture_table = connection.picture_table
-        menu_options = {
+        menu_options = types.MappingProxyType({
             "A": load_users,
             "B": load_status_updates,
             "C": add_user,
@@ -236,31 +456,18 @@ if __name__ == "__main__":
             "K": add_picture,
             "L": list_user_images,
             "M": reconcile_images,
+            "N": toggle_batch_mode,
+            "P": purge_deleted,
+            "X": clear_caches,
             "Q": quit_program,
-        }
+        })
 
-    while True:
-        user_selection = input(
-            """
-                            A: Load user database
-                            B: Load status database
-                            C: Add user
-                            D: Update user
-                            E: Search user
-                            F: Delete user
-                            G: Add status
-                            H: Update status
-                            I: Search status
-                            J: Delete status
-                            K: Add picture
-                            L: List user images
-                            M: Reconcile images
-                            Q: Quit
+        if not sys.stdin.isatty():
+            # Piped commands: no prompts, one command per line
+            run_scripted(sys.stdin, menu_options)
+            sys.exit()
 
-                            Please enter your choice: """
-        ).upper()
-
-        if user_selection in menu_options:
-            menu_options[user_selection]()
-        else:
-            print("Invalid option")
+        _enable_history()
+        while True:
+            user_selection = input(_MENU_PROMPT).strip().upper()[:1]
+            menu_options.get(user_selection, invalid_option)()
@@ -0,0 +1,133 @@
+"""
+Tests for the social network database functions and API helpers
+"""
+
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from context_manager import Connection, DB_PATH
+
+# pylint: disable = C0103, W0212, W0603
+
+# Working directory the tests run in, so the database and pictures folder are throwaway
+_tmp_dir = None
+_old_cwd = None
+api = None
+
+
+def setUpModule():
+    """
+    Moves into an empty directory with empty tables, then imports the API,
+    which reflects the database schema when imported
+    """
+    global _tmp_dir, _old_cwd, api
+    _old_cwd = os.getcwd()
+    _tmp_dir = tempfile.mkdtemp()
+    os.chdir(_tmp_dir)
+    with Connection(DB_PATH):
+        pass  # Creates the users, status and pictures tables
+    api = importlib.import_module("api")
+
+
+def tearDownModule():
+    """
+    Returns to the original directory and removes the temporary one
+    """
+    os.chdir(_old_cwd)
+    shutil.rmtree(_tmp_dir, ignore_errors=True)
+
+
+class SortedDifferenceTest(unittest.TestCase):
+    """
+    Tests for api._sorted_difference
+    """
+
+    def test_interleaved(self):
+        """Items only on one side are reported on that side"""
+        self.assertEqual(api._sorted_difference([1, 3, 5, 7], [2, 3, 6, 7]), ([1, 5], [2, 6]))
+
+    def test_duplicates(self):
+        """Repeated items are reported once, and not at all when both sides have them"""
+        self.assertEqual(api._sorted_difference([1, 1, 2, 2, 4], [2, 3, 3, 4, 4]), ([1], [3]))
+
+    def test_one_side_empty(self):
+        """Everything on the non-empty side is reported"""
+        self.assertEqual(api._sorted_difference([], [1, 2, 2]), ([], [1, 2]))
+        self.assertEqual(api._sorted_difference([1, 2, 2], []), ([1, 2], []))
+        self.assertEqual(api._sorted_difference([], []), ([], []))
+
+    def test_matches_sets(self):
+        """Agrees with set arithmetic on tuples like the ones compared in Differences"""
+        left = sorted([
+            ("u1", "cat/1.png", "1.png"),
+            ("u1", "dog/2.png", "2.png"),
+            ("u2", "3.png", "3.png"),
+        ])
+        right = sorted([("u1", "dog/2.png", "2.png"), ("u2", "4.png", "4.png")])
+        only_left, only_right = api._sorted_difference(left, right)
+        self.assertEqual(only_left, sorted(set(left) - set(right)))
+        self.assertEqual(only_right, sorted(set(right) - set(left)))
+
+
+class DeconstructTagsTest(unittest.TestCase):
+    """
+    Tests for main.deconstruct_tags
+    """
+
+    def test_sorted(self):
+        """Tags come back sorted, without the '#'"""
+        self.assertEqual(main.deconstruct_tags("#dog #cat #bird"), ("bird", "cat", "dog"))
+
+    def test_only_words_starting_with_hash(self):
+        """A '#' inside a word does not start a tag"""
+        self.assertEqual(main.deconstruct_tags("no#tag #yes"), ("yes",))
+
+    def test_no_tags(self):
+        """Text without tags gives an empty tuple"""
+        self.assertEqual(main.deconstruct_tags(""), ())
+        self.assertEqual(main.deconstruct_tags("plain text"), ())
+
+
+class SoftDeleteTest(unittest.TestCase):
+    """
+    Tests for soft-deleting users and statuses and purging them
+    """
+
+    def setUp(self):
+        main.add_user(DB_PATH, "sd_user", "Soft", "Delete", "sd@example.com")
+        main.add_status(DB_PATH, "sd_status", "sd_user", "hello")
+        main.create_indexes(DB_PATH)
+
+    def find_row(self, table_name, **query):
+        """Returns the row whether or not it is soft-deleted"""
+        with Connection(DB_PATH) as db:
+            return db.ds[table_name].find_one(**query)
+
+    def test_delete_then_purge(self):
+        """Deleted rows are hidden until purged, then gone"""
+        self.assertTrue(main.delete_user("sd_user", DB_PATH))
+        self.assertIsNone(main.search_user(DB_PATH)("sd_user"))
+        self.assertIsNone(main.search_status(DB_PATH, "sd_status"))
+        self.assertIsNotNone(self.find_row("users", user_id="sd_user")["deleted_at"])
+        self.assertIsNotNone(self.find_row("status", status_id="sd_status")["deleted_at"])
+
+        self.assertGreaterEqual(main.purge_deleted(DB_PATH), 2)
+        self.assertIsNone(self.find_row("users", user_id="sd_user"))
+        self.assertIsNone(self.find_row("status", status_id="sd_status"))
+
+    def test_user_id_reusable_after_delete(self):
+        """Only live user_ids must be unique"""
+        self.assertFalse(main.add_user(DB_PATH, "sd_user", "Again", "User", "again@example.com"))
+        self.assertTrue(main.delete_user("sd_user", DB_PATH))
+        self.assertTrue(main.add_user(DB_PATH, "sd_user", "Again", "User", "again@example.com"))
+        self.assertEqual(main.search_user(DB_PATH)("sd_user")["user_name"], "Again")
+        main.delete_user("sd_user", DB_PATH)
+        main.purge_deleted(DB_PATH)
+
+
+if __name__ == "__main__":
+    unittest.main()